@@ -1,6 +1,6 @@
 # a GIF decoder in pure Python
 
-import argparse, os, struct, sys, time
+import argparse, io, os, sys, time
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -36,13 +36,36 @@ def get_bytes(handle, length):
         sys.exit("Unexpected end of file.")
     return data
 
-def generate_subblocks(handle):
-    # generate data from GIF subblocks
+def skip_subblocks(handle):
+    # skip GIF subblocks by seeking past their data
     sbSize = get_bytes(handle, 1)[0]  # subblock size
     while sbSize:
-        chunk = get_bytes(handle, sbSize + 1)  # subblock & size of next one
-        yield chunk[:-1]
-        sbSize = chunk[-1]
+        handle.seek(sbSize, 1)
+        sbSize = get_bytes(handle, 1)[0]
+
+def get_subblock_data(handle):
+    # read GIF subblocks, return their data concatenated (bytearray);
+    # first find the total size by skipping from one size byte to the next,
+    # then read the subblocks straight into a buffer of that size
+
+    start = handle.tell()
+    dataSize = 0
+    sbSize = get_bytes(handle, 1)[0]  # subblock size
+    while sbSize:
+        dataSize += sbSize
+        handle.seek(sbSize, 1)
+        sbSize = get_bytes(handle, 1)[0]
+
+    handle.seek(start)
+    data = bytearray(dataSize)
+    view = memoryview(data)
+    pos = 0  # write position in data
+    sbSize = handle.read(1)[0]
+    while sbSize:
+        handle.readinto(view[pos:pos+sbSize])
+        pos += sbSize
+        sbSize = handle.read(1)[0]
+    return data
 
 def get_image_info(handle):
     # read information of one image in GIF file
@@ -56,7 +79,10 @@ def get_image_info(handle):
     #     lzwPalBits: palette bit depth in LZW encoding
     #     lzwAddr:    LZW data address
 
-    (width, height, miscFields) = struct.unpack("<4x2HB", get_bytes(handle, 9))
+    descriptor = get_bytes(handle, 9)  # x, y, width, height, packed fields
+    width = int.from_bytes(descriptor[4:6], "little")
+    height = int.from_bytes(descriptor[6:8], "little")
+    miscFields = descriptor[8]
     if min(width, height) == 0:
         sys.exit("Image area is zero.")
 
@@ -92,10 +118,10 @@ def skip_extension_block(handle):
     if label in (0x01, 0xf9, 0xff):
         # Plain Text Extension, Graphic Control Extension, Application Ext.
         get_bytes(handle, get_bytes(handle, 1)[0])  # skip bytes
-        all(generate_subblocks(handle))  # skip subblocks
+        skip_subblocks(handle)
     elif label == 0xfe:
         # Comment Extension
-        all(generate_subblocks(handle))  # skip subblocks
+        skip_subblocks(handle)
     else:
         sys.exit("Invalid Extension label.")
 
@@ -126,14 +152,15 @@ def get_gif_info(handle):
     handle.seek(0)
 
     # Header
-    (id_, version) = struct.unpack("3s3s", get_bytes(handle, 6))
+    header = get_bytes(handle, 6)
+    (id_, version) = (header[:3], header[3:])
     if id_ != b"GIF":
         sys.exit("Not a GIF file.")
     if version not in (b"87a", b"89a"):
         print("Warning: unknown GIF version.", file=sys.stderr)
 
     # Logical Screen Descriptor
-    packedFields = struct.unpack("4xB2x", get_bytes(handle, 7))[0]
+    packedFields = get_bytes(handle, 7)[4]
     if packedFields & 0b10000000:
         # has Global Color Table
         palAddr = handle.tell()
@@ -166,139 +193,145 @@ def get_gif_info(handle):
         "lzwAddr":    imageInfo["lzwAddr"],
     }
 
-def lzw_decode(data, palBits, args):
+def lzw_decode(data, palBits, pixelCount, args):
     # decode Lempel-Ziv-Welch (LZW) data (bytes)
-    # palBits: palette bit depth in LZW encoding (2-8)
+    # palBits: palette bit depth in LZW encoding (2-11)
+    # pixelCount: expected number of pixels (width * height)
     # return: indexed image data (bytes)
 
     pos       = 0                 # byte position in LZW data
-    bitPos    = 0                 # bit position within LZW data byte (0-7)
+    datum     = 0                 # bits read from LZW data but not used yet
+    bitCnt    = 0                 # number of bits in datum (0-63)
     codeLen   = palBits + 1       # current length of LZW codes, in bits (3-12)
+    codeMask  = 2 ** codeLen - 1  # bitmask for current code length
     code      = 0                 # current LZW code (0-4095)
     prevCode  = None              # previous code for dictionary entry or None
     clearCode = 2 ** palBits      # LZW clear code
     endCode   = 2 ** palBits + 1  # LZW end code
-    entry     = bytearray()       # reconstructed dictionary entry
-    imageData = bytearray()       # decoded image data
+    nextCode  = 2 ** palBits + 2  # next free code (length of dictionary)
+    outPos    = 0                 # write position in imageData
     codeCount = 0                 # number of LZW codes read (statistics only)
-    bitCount  = 0                 # number of LZW bits read (statistics only)
 
-    # LZW dictionary: index = code, value = entry (reference to another code,
-    # final byte)
-    lzwDict = [(None, i) for i in range(2 ** palBits + 2)]
+    # decoded image data (preallocated; grows if there's too much data); don't
+    # preallocate more than the LZW data can produce (each code takes at least
+    # palBits + 1 bits and decodes to at most 4096 pixels) in case the image
+    # size is bogus
+    imageData = bytearray(
+        min(pixelCount, len(data) * 8 // (palBits + 1) * 4096)
+    )
+
+    # LZW dictionary: index = code, value = entry (bytes); entries are stored
+    # whole so each one can be copied to the output at once; fixed size, only
+    # codes below nextCode are in use; clear and end codes have empty entries;
+    # if palBits > 8, codes 256 to clearCode - 1 can't be stored in a byte and
+    # are rejected below
+    lzwDict = [bytes((i,)) for i in range(min(2 ** palBits, 256))]
+    lzwDict.extend((2 ** 12 - len(lzwDict)) * [b""])
 
     while True:
-        # get current LZW code (0-4095) from remaining data:
-        # 1) get the 1-3 bytes that contain the code; equivalent to:
-        # codeByteCnt = ceil((bitPos + codeLen) / 8)
-        codeByteCnt = (bitPos + codeLen + 7) // 8
-        if pos + codeByteCnt > len(data):
-            sys.exit("Unexpected end of file.")
-        codeBytes = data[pos:pos+codeByteCnt]
-        # 2) convert the bytes into an integer (first byte = least significant)
-        code = sum(b << (i * 8) for (i, b) in enumerate(codeBytes))
-        # 3) delete previously-read bits from the end and unnecessary bits
-        # from the beginning; equivalent to:
-        # code = (code >> bitPos) % 2 ** codeLen
-        code = (code >> bitPos) & ((1 << codeLen) - 1)
-
-        # advance byte/bit position so the next code can be read correctly
-        bitPos += codeLen
-        pos += bitPos >> 3  # pos += bitPos // 8
-        bitPos &= 0b111     # bitPos %= 8
-
-        # update statistics
+        # get current LZW code (0-4095) from remaining data: if there aren't
+        # enough bits, shift in up to 7 bytes at once (first byte = least
+        # significant), then take the code from the low end
+        if bitCnt < codeLen:
+            chunk = data[pos:pos+7]
+            datum |= int.from_bytes(chunk, "little") << bitCnt
+            pos += len(chunk)
+            bitCnt += len(chunk) * 8
+            if bitCnt < codeLen:
+                sys.exit("Unexpected end of file.")
+        code = datum & codeMask
+        datum >>= codeLen
+        bitCnt -= codeLen
+
         codeCount += 1
-        bitCount += codeLen
 
         if code == clearCode:
             # LZW clear code:
             # reset dict. & code length; don't add dict. entry with next code
-            lzwDict = lzwDict[:2**palBits+2]
+            nextCode = 2 ** palBits + 2
             codeLen = palBits + 1
+            codeMask = 2 ** codeLen - 1
             prevCode = None
         elif code == endCode:
             break
-        elif code > len(lzwDict):
+        elif code > nextCode or code == nextCode and prevCode is None:
             sys.exit("Invalid LZW code.")
+        elif clearCode > code >= 256:
+            # literal code that doesn't fit in a byte (only if palBits > 8)
+            sys.exit("Invalid index in image data.")
         else:
             # dictionary entry
             if prevCode is not None:
-                # add new entry (previous code, first byte of current/previous
+                # add new entry (previous entry, first byte of current/previous
                 # entry)
-                suffixCode = code if code < len(lzwDict) else prevCode
-                while suffixCode is not None:
-                    (suffixCode, suffixByte) = lzwDict[suffixCode]
-                lzwDict.append((prevCode, suffixByte))
+                suffixCode = code if code < nextCode else prevCode
+                lzwDict[nextCode] = lzwDict[prevCode] + lzwDict[suffixCode][:1]
+                nextCode += 1
+                # increase code length if next free code doesn't fit
+                if nextCode > codeMask and codeLen < 12:
+                    codeLen += 1
+                    codeMask = 2 ** codeLen - 1
                 prevCode = None
-            # reconstruct and store entry
-            entry.clear()
-            referredCode = code
-            while referredCode is not None:
-                (referredCode, byte) = lzwDict[referredCode]
-                entry.append(byte)
-            entry.reverse()
-            imageData.extend(entry)
+            # store entry
+            entry = lzwDict[code]
+            imageData[outPos:outPos+len(entry)] = entry
+            outPos += len(entry)
             # prepare to add a dictionary entry
-            if len(lzwDict) < 2 ** 12:
+            if nextCode < 2 ** 12:
                 prevCode = code
-            if len(lzwDict) == 2 ** codeLen and codeLen < 12:
-                codeLen += 1
+
+    del imageData[outPos:]  # in case of too little data
 
     if args.verbose:
         print(
-            f"LZW data: {codeCount} codes, {bitCount} bits, {len(imageData)} "
-            "pixels"
+            f"LZW data: {codeCount} codes, {pos*8-bitCnt} bits, "
+            f"{len(imageData)} pixels"
         )
 
     return imageData
 
-def get_deinterlace_order(height):
-    # generate one interlaced (source) pixel row index for each deinterlaced
-    # (destination) pixel row index;
-    # e.g. if height = 8, generate: 0, 4, 2, 5, 1, 6, 3, 7
-
+def deinterlace(imageData, width):
+    # deinterlace image data (1 byte/pixel), return deinterlaced data;
+    # the interlaced (source) pixel rows are in four groups, each of which
+    # is copied to every 8th/8th/4th/2nd deinterlaced (destination) row:
     # group 1: pixel rows 0,  8, 16, ...
     # group 2: pixel rows 4, 12, 20, ...
     # group 3: pixel rows 2,  6, 10, ...
     # group 4: pixel rows 1,  3,  5, ...
+    # e.g. if height = 8, destination rows 0-7 come from source rows 0, 4, 2,
+    # 5, 1, 6, 3, 7
 
-    group2Start = (height + 7) // 8  # pixel rows in group  1
-    group3Start = (height + 3) // 4  # pixel rows in groups 1-2
-    group4Start = (height + 1) // 2  # pixel rows in groups 1-3
-
-    for dy in range(height):  # pixel row destination index
-        if dy % 8 == 0:
-            yield dy // 8
-        elif dy % 8 == 4:
-            yield group2Start + dy // 8
-        elif dy % 4 == 2:
-            yield group3Start + dy // 4
-        else:
-            yield group4Start + dy // 2
+    height = len(imageData) // width
+    source = memoryview(imageData)
+    deinterlaced = bytearray(height * width)
 
-def deinterlace(imageData, width):
-    # deinterlace image data (1 byte/pixel), generate one pixel row per call
+    sy = 0  # pixel row source index
+    for (start, step) in ((0, 8), (4, 8), (2, 4), (1, 2)):
+        for dy in range(start, height, step):  # pixel row destination index
+            deinterlaced[dy*width:(dy+1)*width] \
+            = source[sy*width:(sy+1)*width]
+            sy += 1
 
-    height = len(imageData) // width
-    for sy in get_deinterlace_order(height):  # pixel row source index
-        yield imageData[sy*width:(sy+1)*width]
+    return deinterlaced
 
 def main():
     startTime = time.time()
     args = parse_arguments()
 
-    # get palette and LZW image data from input file
+    # read input file into memory at once; parse it from there
     try:
-        with open(args.input_file, "rb") as handle:
-            gifInfo = get_gif_info(handle)
-            handle.seek(gifInfo["palAddr"])
-            palette = get_bytes(handle, 2 ** gifInfo["palBits"] * 3)
-            handle.seek(gifInfo["lzwAddr"])
-            imageData = b"".join(generate_subblocks(handle))
+        with open(args.input_file, "rb", buffering=0) as handle:
+            handle = io.BytesIO(handle.read())
     except OSError:
         sys.exit("Error reading input file.")
 
+    # get palette and LZW image data (no more I/O: handle is in memory)
+    gifInfo = get_gif_info(handle)
+    handle.seek(gifInfo["palAddr"])
+    palette = get_bytes(handle, 2 ** gifInfo["palBits"] * 3)
+    handle.seek(gifInfo["lzwAddr"])
+    imageData = get_subblock_data(handle)
+
     if args.verbose:
         print(
             os.path.basename(args.input_file) + ":",
@@ -306,20 +339,34 @@ def main():
         )
 
     # decode and deinterlace image data
-    imageData = lzw_decode(imageData, gifInfo["lzwPalBits"], args)
-    if max(imageData) >= 2 ** gifInfo["palBits"]:
+    imageData = lzw_decode(
+        imageData, gifInfo["lzwPalBits"],
+        gifInfo["width"] * gifInfo["height"], args
+    )
+    # indexes can only be out of palette if LZW palette is larger; if so,
+    # delete all valid indexes; anything left is invalid
+    if gifInfo["lzwPalBits"] > gifInfo["palBits"] \
+    and imageData.translate(None, bytes(range(2 ** gifInfo["palBits"]))):
         sys.exit("Invalid index in image data.")
     if gifInfo["interlace"]:
-        imageData = b"".join(deinterlace(imageData, gifInfo["width"]))
+        imageData = deinterlace(imageData, gifInfo["width"])
 
-    # tuple of bytestrings
-    palette = tuple(palette[i:i+3] for i in range(0, len(palette), 3))
+    # lookup tables for converting indexed image data into RGB, one per color
+    # channel (padded to 256 entries)
+    tables = [palette[i::3].ljust(256, b"\x00") for i in range(3)]
 
-    # write output file
+    # write output file; convert 2**16 pixels at a time to limit memory use:
+    # look up each color channel with bytes.translate() and interleave the
+    # channels with extended slice assignments
     try:
         with open(args.output_file, "wb") as handle:
             handle.seek(0)
-            handle.write(b"".join(palette[i] for i in imageData))
+            for pos in range(0, len(imageData), 2 ** 16):
+                stripe = imageData[pos:pos+2**16]
+                rgbData = bytearray(len(stripe) * 3)
+                for i in range(3):
+                    rgbData[i::3] = stripe.translate(tables[i])
+                handle.write(rgbData)
     except OSError:
         sys.exit("Error writing output file.")
 
@@ -1,6 +1,6 @@
 # a GIF encoder in pure Python
 
-import argparse, math, os, struct, sys, time
+import argparse, os, struct, sys, time
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -38,151 +38,195 @@ def parse_arguments():
 
     return args
 
-def get_palette(handle):
-    # get palette from raw RGB image, return bytes (RGBRGB...)
+def pack_colors(rgbData):
+    # pad each pixel of raw RGB data to 4 bytes (RGB0) with slice assignments
+    # and view the result as native unsigned ints, so colors can be handled
+    # as ints without creating a bytes object per pixel; return a memoryview
 
-    pixelCount = handle.seek(0, 2) // 3
-    handle.seek(0)
-    palette = {handle.read(3) for i in range(pixelCount)}
-    if len(palette) > 256:
-        sys.exit("Too many unique colors in input file.")
-    return b"".join(sorted(palette))
+    packed = bytearray(len(rgbData) // 3 * 4)
+    for i in range(3):
+        packed[i::4] = rgbData[i::3]
+    return memoryview(packed).cast("I")
+
+def raw_image_to_indexed(rgbData):
+    # convert RGB image data into palette (RGBRGB..., sorted) and indexed image
+    # data (1 byte/pixel); return (palette, indexed_data)
+
+    colors = pack_colors(rgbData)
 
-def raw_image_to_indexed(handle, palette):
-    # convert RGB image into indexed (1 byte/pixel) using palette (RGBRGB...)
+    # key = packed color, value = index to palette (filled in below)
+    rgbToIndex = dict.fromkeys(colors)
+    if len(rgbToIndex) > 256:
+        sys.exit("Too many unique colors in input file.")
 
-    pixelCount = handle.seek(0, 2) // 3
-    handle.seek(0)
-    rgbToIndex = dict(
-        (palette[i*3:(i+1)*3], i) for i in range(len(palette) // 3)
+    palette = sorted(
+        color.to_bytes(4, sys.byteorder)[:3] for color in rgbToIndex
     )
-    return bytes(rgbToIndex[handle.read(3)] for i in range(pixelCount))
+    for (i, rgb) in enumerate(palette):
+        rgbToIndex[int.from_bytes(rgb + b"\x00", sys.byteorder)] = i
+
+    # look up packed colors with map() so the loop runs in C
+    return (b"".join(palette), bytes(map(rgbToIndex.__getitem__, colors)))
 
-def generate_lzw_codes(palBits, imageData, args):
+def lzw_encode(palBits, imageData, args):
     # encode image data using LZW (Lempel-Ziv-Welch)
     # palBits:   palette bit depth in encoding (2-8)
     # imageData: indexed image data (1 byte/pixel)
-    # generate:  (code, code_length_in_bits)
+    # return:    LZW data (bytes)
 
     # TODO: find out why this function encodes wolf3.gif and wolf4.gif
     # different from GIMP.
 
-    # LZW dictionary (key = LZW entry, value = LZW code)
-    # note: doesn't contain clear and end codes, so actual length is len() + 2
-    # note: uses a lot of memory but looking up an entry is fast
-    lzwDict = dict((bytes((i,)), i) for i in range(2 ** palBits))
-
-    pos     = 0            # position in input data
-    codeLen = palBits + 1  # length of LZW codes (3-12)
-    entry   = bytearray()  # dictionary entry
-
-    yield (2 ** palBits, codeLen)  # clear code
-
-    while pos < len(imageData):
-        # find longest entry that's a prefix of remaining input data, and
-        # corresponding code; TODO: [pos:pos+1] instead of [pos:] breaks some
-        # decoders, investigate further
-        entry.clear()
-        for byte in imageData[pos:]:
-            entry.append(byte)
-            try:
-                code = lzwDict[bytes(entry)]
-            except KeyError:
-                entry = entry[:-1]
-                break
-
-        yield (code, codeLen)  # code for entry
-
-        # advance in input data; if there's data left, update dictionary
-        pos += len(entry)
-        if pos < len(imageData):
-            if len(lzwDict) < 2 ** 12 - 2:
-                # dictionary not full; add entry (current entry plus next
-                # pixel); increase code length if necessary
-                entry.append(imageData[pos])
-                lzwDict[bytes(entry)] = len(lzwDict) + 2
-                if len(lzwDict) > 2 ** codeLen - 2:
-                    codeLen += 1
-            elif not args.no_dict_reset:
-                # dict. full; output clear code; reset code length & dict.
-                yield (2 ** palBits, codeLen)
-                codeLen = palBits + 1
-                lzwDict = dict((bytes((i,)), i) for i in range(2 ** palBits))
-
-    yield (2 ** palBits + 1, codeLen)  # end code
-
-def generate_lzw_bytes(paletteBits, imageData, args):
-    # get LZW codes, generate LZW data bytes
-
-    data    = 0  # LZW codes to convert into bytes (max. 7 + 12 = 19 bits)
-    dataLen = 0  # data length in bits
-
-    codeCount    = 0  # codes written
-    totalCodeLen = 0  # bits written
-
-    for (code, codeLen) in generate_lzw_codes(paletteBits, imageData, args):
-        # prepend code to data
+    # LZW dictionary as a table indexed directly by code of an entry
+    # << palBits | next byte (no hashing or probing needed because there are
+    # only 2 ** (12 + palBits) possible keys); value = code of that entry plus
+    # the byte, or 0 if not in dictionary; entries of one byte aren't stored
+    # because their codes equal the bytes; usedKeys lists the indexes filled
+    # since the last reset so the table can be cleared quickly
+    lzwTable = [0] * 2 ** (12 + palBits)
+    usedKeys = []
+
+    codeLen   = palBits + 1       # length of LZW codes (3-12)
+    codeLimit = 2 ** codeLen      # first code that needs a longer code length
+    clearCode = 2 ** palBits      # LZW clear code
+    endCode   = 2 ** palBits + 1  # LZW end code
+    nextCode  = clearCode + 2     # next free code in dictionary
+
+    # preallocated output; upper bound: at most one code per pixel plus clear
+    # and end codes, 12 bits per code
+    dataBytes = bytearray(len(imageData) * 2 + 8)
+    dataPos   = 0  # write position in dataBytes
+
+    # LZW codes to convert into bytes (max. 63 + 12 + 12 = 87 bits) and its
+    # length in bits; start with a clear code
+    data    = clearCode
+    dataLen = codeLen
+
+    codeCount    = 1        # codes written (statistics only)
+    totalCodeLen = codeLen  # bits written (statistics only)
+
+    # code of longest entry that's a prefix of the data read so far
+    code = imageData[0]
+
+    for byte in imageData[1:]:
+        # try to extend the entry with the next pixel
+        key = code << palBits | byte
+        nextEntry = lzwTable[key]
+        if nextEntry:
+            code = nextEntry
+            continue
+
+        # can't extend; prepend code for entry to data; chop off 8 bytes at a
+        # time from end of data
         data |= code << dataLen
         dataLen += codeLen
-        # chop off full bytes from end of data
-        while dataLen >= 8:
-            yield data & 0xff
-            data >>= 8
-            dataLen -= 8
-        # update stats
+        if dataLen >= 64:
+            dataBytes[dataPos:dataPos+8] \
+            = (data & 0xffff_ffff_ffff_ffff).to_bytes(8, "little")
+            dataPos += 8
+            data >>= 64
+            dataLen -= 64
         codeCount += 1
         totalCodeLen += codeLen
 
-    if dataLen:
-        yield data  # the last byte
+        if nextCode < 2 ** 12:
+            # dictionary not full; add entry (current entry plus next pixel);
+            # increase code length if necessary
+            lzwTable[key] = nextCode
+            usedKeys.append(key)
+            nextCode += 1
+            if nextCode > codeLimit:
+                codeLen += 1
+                codeLimit *= 2
+        elif not args.no_dict_reset:
+            # dict. full; prepend clear code to data (the next code will
+            # flush it); reset code length & dict.
+            data |= clearCode << dataLen
+            dataLen += codeLen
+            codeCount += 1
+            totalCodeLen += codeLen
+            codeLen = palBits + 1
+            codeLimit = 2 ** codeLen
+            for key in usedKeys:
+                lzwTable[key] = 0
+            usedKeys.clear()
+            nextCode = clearCode + 2
+
+        # start a new entry from the pixel
+        code = byte
+
+    # prepend code for last entry to data
+    data |= code << dataLen
+    dataLen += codeLen
+    codeCount += 1
+    totalCodeLen += codeLen
+
+    # prepend end code to data; flush all of data including the last byte
+    data |= endCode << dataLen
+    dataLen += codeLen
+    codeCount += 1
+    totalCodeLen += codeLen
+    dataBytes[dataPos:dataPos+(dataLen+7)//8] \
+    = data.to_bytes((dataLen + 7) // 8, "little")
+    dataPos += (dataLen + 7) // 8
 
     if args.verbose:
         print(f"LZW data: {codeCount} codes, {totalCodeLen} bits")
 
-def generate_gif(palette, imageData, args):
-    # generate a GIF file (version 87a, one image) as bytestrings
+    del dataBytes[dataPos:]
+    return dataBytes
+
+def build_gif(palette, imageData, args):
+    # build a GIF file (version 87a, one image) in one preallocated buffer
     # palette: 3 bytes/color, imageData: 1 byte/pixel
+    # return:  the file (bytearray)
 
     height = len(imageData) // args.width  # image height
 
     # palette size in bits in Global Color Table (1-8) / in LZW encoding (2-8)
-    palBitsGct = max(math.ceil(math.log2(len(palette) // 3)), 1)
+    palBitsGct = max((len(palette) // 3 - 1).bit_length(), 1)
     palBitsLzw = max(palBitsGct, 2)
 
-    yield b"GIF87a"  # Header (signature, version)
+    lzwBytes = lzw_encode(palBitsLzw, imageData, args)
 
-    # Logical Screen Descriptor
-    yield struct.pack(
-        "<2H3B",
+    # Header, Logical Screen Descriptor, Global Color Table, Image
+    # Descriptor, LZW palette bit depth, LZW data in subblocks (length byte +
+    # 255 LZW bytes or less), empty subblock and trailer
+    gctLen = 2 ** palBitsGct * 3  # GCT size in bytes (palette + padding)
+    headerLen = 6 + 7 + gctLen + 10 + 1
+    gif = bytearray(
+        headerLen + len(lzwBytes) + (len(lzwBytes) + 0xfe) // 0xff + 2
+    )
+
+    # Header (signature, version) and Logical Screen Descriptor
+    struct.pack_into(
+        "<6s2H3B", gif, 0,
+        b"GIF87a",
         args.width, height,           # logical screen width/height
         0b10000000 | palBitsGct - 1,  # packed fields (GCT present)
         0, 0                          # background color index, aspect ratio
     )
 
-    yield palette + (2 ** palBitsGct * 3 - len(palette)) * b"\x00"  # pad GCT
+    # Global Color Table (the rest of it is already zero-padded)
+    gif[13:13+len(palette)] = palette
 
-    # Image Descriptor
-    yield struct.pack(
-        "<s4HB",
+    # Image Descriptor and LZW palette bit depth
+    struct.pack_into(
+        "<s4H2B", gif, 13 + gctLen,
         b",", 0, 0,          # image separator, image left/top position
         args.width, height,  # image width/height
-        0b00000000           # packed fields
+        0b00000000,          # packed fields
+        palBitsLzw
     )
 
-    yield bytes((palBitsLzw,))
-
-    # LZW data in subblocks (length byte + 255 LZW bytes or less)
-    subblock = bytearray()
-    for lzwByte in generate_lzw_bytes(palBitsLzw, imageData, args):
-        subblock.append(lzwByte)
-        if len(subblock) == 0xff:
-            # flush subblock
-            yield bytes((len(subblock),)) + subblock
-            subblock.clear()
-    if subblock:
-        yield bytes((len(subblock),)) + subblock  # the last subblock
-
-    yield b"\x00;"  # empty subblock, trailer
+    dst = headerLen  # write position in gif
+    for src in range(0, len(lzwBytes), 0xff):
+        size = min(len(lzwBytes) - src, 0xff)
+        gif[dst] = size
+        gif[dst+1:dst+1+size] = lzwBytes[src:src+size]
+        dst += size + 1
+    gif[dst:] = b"\x00;"
+    return gif
 
 def main():
     startTime = time.time()
@@ -195,33 +239,34 @@ def main():
         (height, remainder) = divmod(size, args.width * 3)
         if remainder or not 1 <= height <= 0xffff:
             sys.exit("Invalid input file size.")
-        # get palette and indexed image data
+        # read the whole file at once
         with open(args.input_file, "rb") as handle:
-            palette = get_palette(handle)
-            imageData = raw_image_to_indexed(handle, palette)
+            rgbData = handle.read()
     except OSError:
         sys.exit("Error reading input file.")
 
+    # get palette and indexed image data
+    (palette, imageData) = raw_image_to_indexed(rgbData)
+
     if args.verbose:
         print(
             f"read {os.path.basename(args.input_file)}: {args.width}*{height} "
             f"pixels, {len(palette)//3} unique color(s)"
         )
 
-    # write output file
+    gif = build_gif(palette, imageData, args)
+
+    # write output file at once
     try:
         with open(args.output_file, "wb") as handle:
-            handle.seek(0)
-            for chunk in generate_gif(palette, imageData, args):
-                handle.write(chunk)
-            size = handle.seek(0, 2)
+            handle.write(gif)
     except OSError:
         sys.exit("Error writing output file.")
 
     if args.verbose:
         print(
-            f"wrote {os.path.basename(args.output_file)}: {size} bytes, time "
-            f"{time.time()-startTime:.1f} s"
+            f"wrote {os.path.basename(args.output_file)}: {len(gif)} bytes, "
+            f"time {time.time()-startTime:.1f} s"
         )
 
 main()
@@ -1,6 +1,6 @@
 # print the high-level structure of a GIF file
 
-import os, struct, sys
+import io, os, struct, sys
 
 # for Graphic Control Extension
 DISPOSAL_METHODS = {
@@ -45,12 +45,24 @@ def get_subblocks(handle):
         yield chunk[:-1]
         sbSize = chunk[-1]
 
+def skip_subblocks(handle):
+    # skip GIF subblocks by seeking from one size byte to the next; return
+    # total size of their data
+    dataSize = 0
+    sbSize = getbytes(handle, 1)[0]  # subblock size
+    while sbSize:
+        dataSize += sbSize
+        handle.seek(sbSize, 1)
+        sbSize = getbytes(handle, 1)[0]
+    return dataSize
+
 # -----------------------------------------------------------------------------
 
 def read_header(handle):
     # read Header from current file position; return file version
 
-    (id_, version) = struct.unpack("3s3s", getbytes(handle, 6))
+    header = getbytes(handle, 6)
+    (id_, version) = (header[:3], header[3:])
     if id_ != b"GIF":
         error("not a GIF file")
     return version
@@ -99,8 +111,8 @@ def read_extension_block(handle):
     if label == 0x01:
         # TODO (low priority): print more info
         printval("type", "Plain Text")
-        getbytes(handle, 13)  # skip bytes
-        list(get_subblocks(handle))  # skip subblocks
+        handle.seek(13, 1)  # skip bytes
+        skip_subblocks(handle)
     elif label == 0xf9:
         printval("type", "Graphic Control")
         (packedFields, delayTime, transparentIndex) \
@@ -128,7 +140,7 @@ def read_extension_block(handle):
         (identifier, authCode) = struct.unpack("x8s3s", getbytes(handle, 12))
         printval("identifier", identifier)
         printval("authentication code", authCode)
-        list(get_subblocks(handle))  # skip subblocks
+        skip_subblocks(handle)
     else:
         error("unknown extension type")
 
@@ -188,7 +200,7 @@ def read_file(handle):
             # TODO (low priority): print more info
             printoffs(handle)
             lzwPalBits = getbytes(handle, 1)[0]
-            lzwDataLen = sum(len(d) for d in get_subblocks(handle))
+            lzwDataLen = skip_subblocks(handle)
             printval("palette bit depth", lzwPalBits)
             printval("data size", lzwDataLen)
         elif blockType == b"!":
@@ -214,8 +226,10 @@ def main():
         error("input file not found")
 
     try:
-        with open(filename, "rb") as handle:
-            read_file(handle)
+        # read the whole file at once and parse it in memory
+        with open(filename, "rb", buffering=0) as handle:
+            handle = io.BytesIO(handle.read())
+        read_file(handle)
     except OSError:
         error("could not read input file")
 